@@ -1,85 +1,234 @@
 # sucesos_app.py
 # Proyecto: Antecedentes de sucesos catastróficos - Tec Laguna / Torreón
 # Autor: Rivaldo Hernández (Administración, Tec Laguna)
-# Requisitos: pip install streamlit pandas matplotlib folium streamlit-folium
+# Requisitos: pip install streamlit pandas matplotlib folium
 
+import io
 import sqlite3
-from hmac import trans_5C
+import threading
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 import datetime
 import matplotlib.pyplot as plt
-from math import exp
 import folium
-from streamlit_folium import st_folium
+from folium.plugins import FastMarkerCluster
 
 DB_PATH = "sucesos_torreon.db"
+# A partir de este número de puntos el mapa agrupa los marcadores en el navegador
+MAX_MARCADORES = 1000
+
+# Construye cada marcador del lado del cliente a partir de [lat, lon, gravedad, popup]
+CALLBACK_MARCADOR = """
+function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {
+        radius: 6 + row[2],
+        color: row[2] >= 4 ? "red" : "orange",
+        fill: true,
+        fillOpacity: 0.7
+    });
+    marker.bindPopup(row[3]);
+    return marker;
+}
+"""
 
 # --------------------------------------------------
 # FUNCIONES DE BASE DE DATOS
 # --------------------------------------------------
+@st.cache_resource
+def get_conn():
+    # Una sola conexión compartida entre reruns y sesiones
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    # WAL permite lectores concurrentes mientras se inserta un suceso
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    # La app casi sólo lee: lectura vía mmap y caché de páginas más grande
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+@st.cache_resource
+def get_lock():
+    # La conexión es compartida por todos los hilos de Streamlit
+    return threading.Lock()
+
+@st.cache_resource
 def crear_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS sucesos (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        fecha TEXT,
-        tipo TEXT,
-        subtipo TEXT,
-        lugar TEXT,
-        lat REAL,
-        lon REAL,
-        gravedad INTEGER,
-        impacto TEXT,
-        fuente TEXT,
-        notas TEXT
-    )
-    ''')
-    conn.commit()
-    conn.close()
+    # Se ejecuta una sola vez por proceso, no en cada rerun
+    conn = get_conn()
+    with get_lock(), conn:
+        cur = conn.cursor()
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS sucesos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha TEXT NOT NULL,
+            tipo TEXT,
+            subtipo TEXT,
+            lugar TEXT,
+            lat REAL,
+            lon REAL,
+            gravedad INTEGER,
+            impacto TEXT,
+            fuente TEXT,
+            notas TEXT
+        )
+        ''')
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_sucesos_fecha ON sucesos(fecha)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_sucesos_tipo ON sucesos(tipo)")
+    return True
+
+def agregar_sucesos_bulk(rows):
+    # Inserta muchas filas en una sola transacción (útil para importar antecedentes)
+    conn = get_conn()
+    with get_lock(), conn:
+        conn.executemany('''
+            INSERT INTO sucesos (fecha, tipo, subtipo, lugar, lat, lon, gravedad, impacto, fuente, notas)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
 
 def agregar_suceso(fecha, tipo, subtipo, lugar, lat, lon, gravedad, impacto, fuente, notas):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT INTO sucesos (fecha, tipo, subtipo, lugar, lat, lon, gravedad, impacto, fuente, notas)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (fecha, tipo, subtipo, lugar, lat, lon, gravedad, impacto, fuente, notas))
-    conn.commit()
-    conn.close()
-
-def cargar_datos():
-    conn = sqlite3.connect(DB_PATH)
-    df = pd.read_sql_query("SELECT * FROM sucesos", conn)
-    conn.close()
-    if not df.empty:
-        df['fecha'] = pd.to_datetime(df['fecha'], errors='coerce')
+    agregar_sucesos_bulk([(fecha, tipo, subtipo, lugar, lat, lon, gravedad, impacto, fuente, notas)])
+
+@st.cache_data(ttl=60, show_spinner=False)
+def cargar_datos(tipos=None, years=None):
+    # Los filtros se resuelven en SQLite; None significa "sin filtro"
+    sql = "SELECT * FROM sucesos"
+    condiciones, params = [], []
+    if tipos is not None:
+        condiciones.append(f"tipo IN ({','.join('?' * len(tipos))})")
+        params.extend(tipos)
+    if years is not None:
+        # fecha es texto ISO-8601: un rango por año aprovecha idx_sucesos_fecha
+        rangos = ["(fecha >= ? AND fecha < ?)"] * len(years)
+        condiciones.append(f"({' OR '.join(rangos) or '0'})")
+        for y in years:
+            params.extend([f"{int(y)}-01-01", f"{int(y) + 1}-01-01"])
+    if condiciones:
+        sql += " WHERE " + " AND ".join(condiciones)
+    sql += " ORDER BY id"
+
+    with get_lock():
+        # Columnas respaldadas por Arrow: texto contiguo en UTF-8 en lugar de objetos de Python.
+        # fecha se interpreta como ISO-8601 igual que en SQLite (con o sin hora), sin inferir
+        # el formato a partir de la primera fila
+        df = pd.read_sql_query(sql, get_conn(), params=params,
+                               parse_dates={"fecha": {"format": "ISO8601", "errors": "coerce"}},
+                               dtype_backend="pyarrow")
+    # El año se usa en filtros, gráficas y probabilidades; se calcula una sola vez
+    df["year"] = df["fecha"].dt.year.astype("Int16")
     return df
 
+@st.cache_data(ttl=60, show_spinner=False)
+def opciones():
+    # Valores para los filtros directamente desde SQLite (usan los índices de tipo y fecha)
+    conn = get_conn()
+    with get_lock():
+        tipos = [r[0] for r in conn.execute(
+            "SELECT DISTINCT tipo FROM sucesos WHERE tipo IS NOT NULL ORDER BY tipo")]
+        years = [r[0] for r in conn.execute(
+            "SELECT DISTINCT CAST(strftime('%Y', fecha) AS INT) AS y FROM sucesos "
+            "WHERE y IS NOT NULL ORDER BY y")]
+    return tipos, years
+
+def version_datos(df):
+    # Los sucesos sólo se agregan, así que (filas, id máximo) identifica la versión de los datos
+    return len(df), df["id"].max() if len(df) else 0
+
+@st.cache_data(hash_funcs={pd.DataFrame: version_datos}, max_entries=1, show_spinner=False)
+def exportar_csv(df):
+    # Se usa to_csv y no pyarrow.csv: Arrow entrecomilla todos los textos y cambiaría el formato
+    return df.drop(columns="year").to_csv(index=False).encode("utf-8")
+
 # --------------------------------------------------
 # FUNCIONES ANALÍTICAS
 # --------------------------------------------------
 def probabilidad_poisson(lmbda):
-    return 1 - exp(-lmbda)
+    return 1 - np.exp(-lmbda)
 
 def resumen_probabilidades(df):
     if df.empty:
         return pd.DataFrame(columns=["Tipo", "Eventos últimos 5 años", "Promedio anual", "Probabilidad (al menos 1/año)"])
-    df["year"] = df["fecha"].dt.year
     current_year = datetime.date.today().year
-    recent = df[df["year"] >= current_year - 4]
-    conteo = recent["tipo"].value_counts()
-    data = []
-    for tipo, n in conteo.items():
-        avg = n / 5
-        p = probabilidad_poisson(avg)
-        data.append({"Tipo": tipo,
-                     "Eventos últimos 5 años": n,
-                     "Promedio anual": round(avg, 2),
-                     "Probabilidad (al menos 1/año)": f"{p*100:.1f}%"})
-    return pd.DataFrame(data)
+    recent = df.loc[df["year"] >= current_year - 4]
+    conteo = recent.groupby("tipo").size().sort_values(ascending=False)
+    avg = conteo / 5
+    p = probabilidad_poisson(avg.to_numpy())
+    return pd.DataFrame({"Tipo": conteo.index,
+                         "Eventos últimos 5 años": conteo.values,
+                         "Promedio anual": avg.round(2).values,
+                         "Probabilidad (al menos 1/año)": [f"{x*100:.1f}%" for x in p]})
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def grafica_frecuencia(resumen):
+    # Se devuelve el PNG ya rasterizado para no rehacer la figura en cada rerun
+    fig, ax = plt.subplots()
+    for tipo in resumen["tipo"].unique():
+        subset = resumen[resumen["tipo"] == tipo]
+        ax.plot(subset["year"].to_numpy(dtype=int), subset["conteo"], marker="o", label=tipo)
+    ax.legend()
+    ax.set_xlabel("Año")
+    ax.set_ylabel("Número de sucesos")
+    ax.set_title("Evolución de sucesos por tipo")
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", bbox_inches="tight")
+    plt.close(fig)
+    return buf.getvalue()
+
+# --------------------------------------------------
+# MAPA
+# --------------------------------------------------
+@st.cache_data(hash_funcs={pd.DataFrame: version_datos}, max_entries=1)
+def construir_mapa(df):
+    # Crear mapa centrado en Torreón
+    mapa = folium.Map(location=[25.539, -103.448], zoom_start=12, tiles="CartoDB positron")
+    con_coords = df.dropna(subset=["lat", "lon"]).copy()
+    # El HTML de los popups se arma por columnas, no fila por fila
+    con_coords["popup"] = (
+        "<b>" + con_coords["tipo"].fillna("") + "</b><br>"
+        + "Fecha: " + con_coords["fecha"].dt.strftime("%Y-%m-%d").fillna("") + "<br>"
+        + "Lugar: " + con_coords["lugar"].fillna("") + "<br>"
+        + "Gravedad: " + con_coords["gravedad"].astype("string").fillna("") + "<br>"
+        + "Impacto: " + con_coords["impacto"].fillna("").str.slice(0, 100) + "..."
+    )
+
+    # Una gravedad nula (p. ej. de una importación masiva) se dibuja como el nivel más bajo
+    gravedad = con_coords["gravedad"].fillna(0).astype(int).tolist()
+
+    if len(con_coords) > MAX_MARCADORES:
+        # Muchos puntos: se envía un solo arreglo y Leaflet arma los clusters
+        puntos = [list(p) for p in zip(
+            con_coords["lat"].tolist(), con_coords["lon"].tolist(),
+            gravedad, con_coords["popup"].tolist()
+        )]
+        FastMarkerCluster(puntos, callback=CALLBACK_MARCADOR).add_to(mapa)
+    else:
+        # Todos los puntos van en una sola capa GeoJson en lugar de un objeto por marcador
+        # El id evita que folium use el popup (único por fila) como identificador de estilo
+        features = [
+            {"type": "Feature",
+             "id": str(id_suceso),
+             "geometry": {"type": "Point", "coordinates": [lon, lat]},
+             "properties": {"grav": grav, "popup": popup}}
+            for id_suceso, lat, lon, grav, popup in zip(
+                con_coords["id"].tolist(), con_coords["lat"].tolist(),
+                con_coords["lon"].tolist(), gravedad, con_coords["popup"].tolist()
+            )
+        ]
+        folium.GeoJson(
+            {"type": "FeatureCollection", "features": features},
+            marker=folium.CircleMarker(radius=6, fill=True),
+            style_function=lambda f: {
+                "radius": 6 + f["properties"]["grav"],
+                "color": "red" if f["properties"]["grav"] >= 4 else "orange",
+                "fillColor": "red" if f["properties"]["grav"] >= 4 else "orange",
+                "fillOpacity": 0.7,
+            },
+            popup=folium.GeoJsonPopup(fields=["popup"], labels=False),
+        ).add_to(mapa)
+
+    return mapa.get_root().render()
 
 # --------------------------------------------------
 # INTERFAZ STREAMLIT
@@ -95,13 +244,15 @@ tabs = st.tabs(["📋 Registrar suceso", "📈 Análisis", "🗺️ Mapa Interac
 # --------------------------------------------------
 # TAB 1: REGISTRO
 # --------------------------------------------------
-with tabs[0]:
+# Cada pestaña es un fragmento: al usar sus widgets sólo se vuelve a ejecutar esa pestaña
+@st.fragment
+def tab_registro():
     st.subheader("Registrar un nuevo suceso")
-    
+
     # === Configurar modo solo lectura ===
-allow_write = st.secrets.get("ALLOW_WRITE", "true").lower() == "true"
-if not allow_write:
-    st.info("🔒 Esta versión es pública y está en modo de solo lectura. Solo se pueden consultar antecedentes.")
+    allow_write = st.secrets.get("ALLOW_WRITE", "true").lower() == "true"
+    if not allow_write:
+        st.info("🔒 Esta versión es pública y está en modo de solo lectura. Solo se pueden consultar antecedentes.")
 
     with st.form("form_suceso"):
         col1, col2 = st.columns(2)
@@ -109,7 +260,7 @@ if not allow_write:
         tipo = col2.selectbox("Tipo de suceso", ["Inundación", "Apagón", "Sismo", "Pandemia", "Protesta", "Derrumbe", "Otro"])
         subtipo = st.text_input("Título / subtipo breve")
         lugar = st.text_input("Lugar (ej. Tec Laguna, Torreón, colonia...)")
-        
+
         c1, c2 = st.columns(2)
         lat = c1.number_input("Latitud (ej. 25.538)", value=25.538, format="%.6f")
         lon = c2.number_input("Longitud (ej. -103.448)", value=-103.448, format="%.6f")
@@ -117,98 +268,84 @@ if not allow_write:
         impacto = st.text_area("Impacto / descripción breve")
         fuente = st.text_input("Fuente o enlace (opcional)")
         notas = st.text_area("Notas adicionales (opcional)")
-        submit = st.form_submit_button("Guardar suceso")
 
-                # --- Botón de guardar ---
+        # --- Botón de guardar ---
         if allow_write:
             submit = st.form_submit_button("Guardar suceso")
             if submit:
                 agregar_suceso(str(fecha), tipo, subtipo, lugar, lat, lon, gravedad, impacto, fuente, notas)
+                cargar_datos.clear()
+                opciones.clear()
+                # El submit sólo reejecuta este fragmento; se reejecuta toda la app
+                # para que Análisis y Mapa muestren el nuevo suceso
+                st.session_state["suceso_guardado"] = True
+                st.rerun()
+            if st.session_state.pop("suceso_guardado", False):
                 st.success("✅ Suceso registrado correctamente.")
         else:
             st.form_submit_button("Guardar suceso", disabled=True)
 
-else:
-    st.form_submit_button("Guardar suceso", disabled=True)
-
+with tabs[0]:
+    tab_registro()
 
 # --------------------------------------------------
 # TAB 2: ANÁLISIS
 # --------------------------------------------------
-with tabs[1]:
+@st.fragment
+def tab_analisis():
     st.subheader("Análisis histórico y probabilidades")
 
     df = cargar_datos()
     if df.empty:
         st.warning("No hay datos registrados todavía.")
-    else:
-        col1, col2 = st.columns(2)
-        tipo_sel = col1.multiselect("Filtrar por tipo", sorted(df["tipo"].unique()), default=sorted(df["tipo"].unique()))
-        años = sorted(df["fecha"].dt.year.unique())
-        año_sel = col2.multiselect("Filtrar por año", años, default=años)
-        filtrado = df[df["tipo"].isin(tipo_sel) & df["fecha"].dt.year.isin(año_sel)]
-
-        st.dataframe(filtrado.sort_values("fecha", ascending=False), use_container_width=True)
-
-        # Gráfica de frecuencia
-        st.markdown("### Frecuencia de sucesos por año")
-        resumen = filtrado.groupby([filtrado["fecha"].dt.year, "tipo"]).size().reset_index(name="conteo")
-        if not resumen.empty:
-            fig, ax = plt.subplots()
-            for tipo in resumen["tipo"].unique():
-                subset = resumen[resumen["tipo"] == tipo]
-                ax.plot(subset["fecha"], subset["conteo"], marker="o", label=tipo)
-            ax.legend()
-            ax.set_xlabel("Año")
-            ax.set_ylabel("Número de sucesos")
-            ax.set_title("Evolución de sucesos por tipo")
-            st.pyplot(fig)
-
-        # Tabla de probabilidades
-        st.markdown("### Probabilidad estimada (últimos 5 años)")
-        tabla_probs = resumen_probabilidades(df)
-        st.dataframe(tabla_probs, use_container_width=True)
-
-        st.download_button(
-            label="📤 Descargar base (CSV)",
-            data=df.to_csv(index=False).encode("utf-8"),
-            file_name="sucesos_torreon.csv",
-            mime="text/csv"
-        )
+        return
+
+    col1, col2 = st.columns(2)
+    tipos, años = opciones()
+    tipo_sel = col1.multiselect("Filtrar por tipo", tipos, default=tipos)
+    año_sel = col2.multiselect("Filtrar por año", años, default=años)
+    # Se filtra la tabla ya cargada con las selecciones reales; así la vista nunca muestra
+    # tipos o años que no estén en las opciones, aunque opciones() y cargar_datos() expiren
+    # en momentos distintos
+    filtrado = df[df["tipo"].isin(tipo_sel) & df["year"].isin(año_sel)]
+
+    # Las filas vienen ordenadas por id (orden de captura); basta invertirlas
+    st.dataframe(filtrado.drop(columns="year").iloc[::-1], width="stretch")
+
+    # Gráfica de frecuencia
+    st.markdown("### Frecuencia de sucesos por año")
+    resumen = filtrado.groupby(["year", "tipo"]).size().reset_index(name="conteo")
+    if not resumen.empty:
+        st.image(grafica_frecuencia(resumen), width="stretch")
+
+    # Tabla de probabilidades
+    st.markdown("### Probabilidad estimada (últimos 5 años)")
+    tabla_probs = resumen_probabilidades(df)
+    st.dataframe(tabla_probs, width="stretch")
+
+    st.download_button(
+        label="📤 Descargar base (CSV)",
+        data=exportar_csv(df),
+        file_name="sucesos_torreon.csv",
+        mime="text/csv"
+    )
+
+with tabs[1]:
+    tab_analisis()
 
 # --------------------------------------------------
 # TAB 3: MAPA
 # --------------------------------------------------
-with tabs[2]:
+@st.fragment
+def tab_mapa():
     st.subheader("🗺️ Mapa interactivo de sucesos registrados")
 
     df = cargar_datos()
     if df.empty:
         st.info("Aún no hay sucesos registrados con coordenadas.")
     else:
-        # Crear mapa centrado en Torreón
-        mapa = folium.Map(location=[25.539, -103.448], zoom_start=12, tiles="CartoDB positron")
-
-        for _, row in df.iterrows():
-            if pd.notnull(row["lat"]) and pd.notnull(row["lon"]):
-                popup = f"""
-                <b>{row['tipo']}</b><br>
-                Fecha: {row['fecha'].date()}<br>
-                Lugar: {row['lugar']}<br>
-                Gravedad: {row['gravedad']}<br>
-                Impacto: {row['impacto'][:100]}...
-                """
-                folium.CircleMarker(
-                    location=[row["lat"], row["lon"]],
-                    radius=6 + row["gravedad"],
-                    color="red" if row["gravedad"] >= 4 else "orange",
-                    fill=True,
-                    fill_opacity=0.7,
-                    popup=popup
-                ).add_to(mapa)
-
-        st_data = st_folium(mapa, width=900, height=550)
-
-
-
+        # El mapa no devuelve eventos a la app, basta con incrustar su HTML
+        st.iframe(construir_mapa(df), width=900, height=550)
 
+with tabs[2]:
+    tab_mapa()